@@ -5,7 +5,8 @@ from contextlib import AsyncExitStack
 from mcp import ClientSession, StdioServerParameters
 from mcp.client.stdio import stdio_client
 
-from llm import process_prompt
+from llm import (process_prompt, get_available_tools, invalidate_schema_cache,
+                 clear_schema_disk_cache, close_anthropic_client)
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -15,6 +16,7 @@ class MCPClient:
         # Initialize session and client objects
         self.session: Optional[ClientSession] = None
         self.exit_stack = AsyncExitStack()
+        self._available_tools: list = []
 
     async def connect_to_server(self, server_script_path: str):
         """Connect to an MCP server
@@ -40,10 +42,20 @@ class MCPClient:
         
         await self.session.initialize()
         
-        # List available tools
+        # List available tools once; the server's tool list is static
+        # for the life of the session, so reuse it on every query
         response = await self.session.list_tools()
-        tools = response.tools
-        print("\nConnected to server with tools:", [tool.name for tool in tools])
+        self._available_tools = [{
+            "name": tool.name,
+            "description": tool.description,
+            "input_schema": tool.inputSchema
+        } for tool in response.tools]
+        print("\nConnected to server with tools:", [tool["name"] for tool in self._available_tools])
+
+    async def refresh_tools(self):
+        """Re-fetch the tool list (e.g. after the server gains tools)"""
+        invalidate_schema_cache(self.session)
+        self._available_tools = await get_available_tools(self.session)
 
     async def chat_loop(self):
         """Run an interactive chat loop"""
@@ -52,12 +64,15 @@ class MCPClient:
         
         while True:
             try:
-                prompt = input("\nQuery: ").strip()
+                # Read input on a worker thread so background tasks
+                # (log writes, schema refresh) keep running while the
+                # user is typing
+                prompt = (await asyncio.to_thread(input, "\nQuery: ")).strip()
                 
                 if prompt.lower() == 'quit':
                     break
                     
-                response = await process_prompt(self.session, prompt)
+                response = await process_prompt(self.session, prompt, self._available_tools)
                 print("\n" + response)
                     
             except Exception as e:
@@ -65,16 +80,22 @@ class MCPClient:
     
     async def cleanup(self):
         """Clean up resources"""
+        await close_anthropic_client()
         await self.exit_stack.aclose()
 
 async def main():
-    if len(sys.argv) < 2:
-        print("Usage: python client.py <path_to_server_script>")
+    args = sys.argv[1:]
+    if "--rebuild-schema-cache" in args:
+        args.remove("--rebuild-schema-cache")
+        clear_schema_disk_cache()
+
+    if len(args) < 1:
+        print("Usage: python client.py <path_to_server_script> [--rebuild-schema-cache]")
         sys.exit(1)
-        
+
     client = MCPClient()
     try:
-        await client.connect_to_server(sys.argv[1])
+        await client.connect_to_server(args[0])
         await client.chat_loop()
     finally:
         await client.cleanup()
@@ -1,13 +1,200 @@
-from anthropic import Anthropic
+from anthropic import AsyncAnthropic
+import asyncio
+import hashlib
+import httpx
+import json
 import os
+import time
+from dataclasses import dataclass
 from dotenv import load_dotenv
 
 load_dotenv()
 
-anthropic_client = Anthropic()
+# Create the log directory once at import instead of on every call
+os.makedirs('data', exist_ok=True)
 
-def create_message(content: str, role: str = "user") -> dict:
-    """Create a properly formatted message for Anthropic API"""
+# Bound every API call so a stalled request can't hang the agent loop;
+# the client retries transient 429/5xx errors with exponential backoff.
+# A single pooled httpx client is shared by all calls so TLS handshakes
+# are amortized across the session instead of paid per connection
+anthropic_client = AsyncAnthropic(
+    http_client=httpx.AsyncClient(
+        limits=httpx.Limits(max_keepalive_connections=20, max_connections=100),
+        timeout=httpx.Timeout(60.0, connect=5.0)
+    ),
+    timeout=httpx.Timeout(60.0, connect=5.0),
+    max_retries=3
+)
+
+# Keep strong references to background tasks: the event loop only holds
+# weak ones, so an untracked log write could be garbage-collected before
+# it runs or cancelled when the loop closes
+_background_tasks: set = set()
+
+def _spawn_background(coro) -> None:
+    task = asyncio.create_task(coro)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+
+async def close_anthropic_client() -> None:
+    """Flush pending background work and close the shared Anthropic client"""
+    if _background_tasks:
+        await asyncio.gather(*_background_tasks, return_exceptions=True)
+    await anthropic_client.close()
+
+# Cap in-flight Anthropic requests so parallel tool fan-out and
+# concurrent users don't trip the API's rate limits
+_llm_semaphore = asyncio.Semaphore(int(os.getenv("LLM_MAX_CONCURRENCY", "5")))
+
+# Planning fills a fixed template, so a small fast model handles it;
+# only execution needs Sonnet-grade reasoning over tool results
+PLANNING_MODEL = "claude-3-5-haiku-20241022"
+EXECUTION_MODEL = "claude-3-5-sonnet-20241022"
+
+# Schema and tool list rarely change within a session, so cache them
+# per session (keyed on id) instead of re-fetching on every prompt
+CACHE_TTL = 300  # seconds
+
+_schema_cache: dict[int, tuple[float, str]] = {}
+_tools_cache: dict[int, tuple[float, list]] = {}
+
+# Tools whose output is deterministic until the schema changes - safe to
+# cache by (tool name, args). query_data is deliberately excluded since
+# it executes arbitrary SQL
+CACHEABLE_TOOLS = {"get_table_schema", "get_db_schema", "read_resource"}
+
+_tool_result_cache: dict[str, str] = {}
+
+# On-disk schema cache so a restarted process skips the (slow) first
+# introspection read; a background refresh catches DDL drift
+SCHEMA_CACHE_PATH = 'data/schema_cache.json'
+SCHEMA_CACHE_MAX_AGE = 3600  # seconds
+
+def _load_schema_from_disk() -> str | None:
+    try:
+        with open(SCHEMA_CACHE_PATH) as f:
+            entry = json.load(f)
+        if time.time() - entry["ts"] < SCHEMA_CACHE_MAX_AGE:
+            return entry["schema"]
+    except (OSError, KeyError, TypeError, ValueError):
+        pass
+    return None
+
+def _save_schema_to_disk(schema: str) -> None:
+    entry = {
+        "ts": time.time(),
+        "schema": schema,
+        "hash": hashlib.sha256(schema.encode()).hexdigest()
+    }
+    with open(SCHEMA_CACHE_PATH, 'w') as f:
+        json.dump(entry, f)
+
+def clear_schema_disk_cache() -> None:
+    """Remove the on-disk schema cache (forces a rebuild on next fetch)"""
+    try:
+        os.remove(SCHEMA_CACHE_PATH)
+    except OSError:
+        pass
+
+def invalidate_schema_cache(session) -> None:
+    """Drop cached schema and tools for a session (e.g. after DDL changes)"""
+    _schema_cache.pop(id(session), None)
+    _tools_cache.pop(id(session), None)
+    prefix = f"{id(session)}:"
+    for key in [k for k in _tool_result_cache if k.startswith(prefix)]:
+        del _tool_result_cache[key]
+    # Drop the disk copy too, or the next fetch would serve it instead
+    # of re-reading from the server
+    clear_schema_disk_cache()
+
+async def call_tool_cached(session, tool_name: str, tool_args: dict) -> str:
+    """Call an MCP tool, reusing cached output for deterministic tools"""
+    key = None
+    if tool_name in CACHEABLE_TOOLS:
+        key = f"{id(session)}:{tool_name}:{json.dumps(tool_args, sort_keys=True)}"
+        if key in _tool_result_cache:
+            return _tool_result_cache[key]
+
+    result = await session.call_tool(tool_name, tool_args)
+    content = str(result.content) if hasattr(result, 'content') else str(result)
+    if key is not None:
+        _tool_result_cache[key] = content
+    return content
+
+# Static instruction text is kept separate from the per-query parts so
+# the invariant prefix (instructions + schema) can be cached by the API
+PLANNING_INSTRUCTIONS = """You are a SQL query planner. Analyze the user's request and create a detailed execution plan.
+
+Create a comprehensive plan in this EXACT format:
+
+# CONTEXT:
+[Elaborate on what the user is asking for - be specific about the data they want]
+
+# OBJECTIVE:
+[Clear statement of what needs to be accomplished, including specific table names and data points needed]
+
+# INSTRUCTIONS:
+[Step-by-step execution plan that includes:
+1. Which table schemas to fetch (use postgres://<tablename>/schema)
+2. What specific data to query for
+3. How to structure the final response]
+
+# EXAMPLE:
+[Show an example of what the final answer should look like]
+
+Make sure to complete ALL sections fully."""
+
+EXECUTION_INSTRUCTIONS = """You are a SQL execution assistant. Use the provided plan to complete the user's request.
+
+Execute the plan step by step:
+1. Use the tools available to gather the required data
+2. Follow the instructions from the plan
+3. Provide a complete answer in the format specified in the EXAMPLE section
+
+Begin execution now."""
+
+# Dynamic tails of the prompts, filled per call with str.format. All
+# prompt text living at module level keeps control flow free of prose
+# and lets prompts be versioned or swapped without touching the phases
+PLANNING_SCHEMA_TEMPLATE = "Available Database Schema: {context}"
+PLANNING_REQUEST_TEMPLATE = "User Request: {prompt}"
+EXECUTION_CONTEXT_TEMPLATE = "ORIGINAL USER REQUEST: {prompt}\n\nEXECUTION PLAN:\n{planning_text}"
+
+def compact_schema(context: str) -> str:
+    """Collapse whitespace in the schema text to shrink input tokens"""
+    return " ".join(context.split())
+
+@dataclass
+class TokenBudget:
+    """Per-query ceiling on cumulative input and output tokens
+
+    Bounds worst-case spend and latency: max_tokens shrinks as the
+    budget drains and the execution loop stops once it is exhausted.
+    """
+    remaining_in: int = 50000
+    remaining_out: int = 8000
+
+    def record(self, usage) -> None:
+        self.remaining_in -= usage.input_tokens
+        self.remaining_out -= usage.output_tokens
+
+    def exhausted(self) -> bool:
+        return self.remaining_in <= 0 or self.remaining_out < 256
+
+def _write_log_file(path: str, text: str) -> None:
+    with open(path, 'w+') as f:
+        f.write(text)
+
+def write_log(path: str, text: str) -> None:
+    """Write a log file in the background so callers aren't blocked on disk I/O"""
+    _spawn_background(asyncio.to_thread(_write_log_file, path, text))
+
+def create_message(content, role: str = "user") -> dict:
+    """Create a properly formatted message for Anthropic API
+
+    content may be a plain string or a list of content blocks (used to
+    mark cacheable prefixes with cache_control).
+    """
     return {
         "role": role,
         "content": content
@@ -15,111 +202,156 @@ def create_message(content: str, role: str = "user") -> dict:
 
 async def call_anthropic(messages: list, 
                          available_tools: list = None, 
-                         max_tokens: int = 1000, 
-                         model: str = "claude-3-5-sonnet-20241022") -> object:
-    """Make a call to Anthropic API with given parameters"""
-    return anthropic_client.messages.create(
-        model=model,
-        max_tokens=max_tokens,
-        messages=messages,
-        tools=available_tools if available_tools else []
-    )
+                         max_tokens: int = 1000,
+                         model: str = EXECUTION_MODEL) -> object:
+    """Make a call to Anthropic API, streaming the response as it arrives"""
+    wait_start = time.monotonic()
+    async with _llm_semaphore:
+        waited = time.monotonic() - wait_start
+        if waited > 0.1:
+            print(f"Waited {waited:.2f}s for LLM concurrency slot")
+
+        # Stream so tokens are consumed as they arrive instead of
+        # materializing the full response before any processing
+        request_start = time.monotonic()
+        first_delta_at = None
+        async with anthropic_client.messages.stream(
+            model=model,
+            max_tokens=max_tokens,
+            messages=messages,
+            tools=available_tools if available_tools else []
+        ) as stream:
+            async for event in stream:
+                if first_delta_at is None and event.type == 'content_block_delta':
+                    first_delta_at = time.monotonic()
+                    print(f"Time to first token: {first_delta_at - request_start:.2f}s")
+            return await stream.get_final_message()
 
 def extract_response_text(response) -> str:
     """Extract text content from Anthropic API response"""
-    response_text = ""
+    parts = []
     if response.content and len(response.content) > 0:
         for content_block in response.content:
-            if hasattr(content_block, 'text'):
-                response_text += content_block.text
-            elif hasattr(content_block, 'type') and content_block.type == 'text':
-                response_text += str(content_block)
-    return response_text
+            text = getattr(content_block, 'text', None)
+            if text is not None:
+                parts.append(text)
+            elif getattr(content_block, 'type', None) == 'text':
+                parts.append(str(content_block))
+    return "".join(parts)
+
+async def _fetch_schema(session) -> str:
+    """Read the schema resource from the MCP server"""
+    context_response = await session.read_resource("postgres://schema")
+    if context_response.contents and len(context_response.contents) > 0:
+        first_content = context_response.contents[0]
+        if hasattr(first_content, 'text'):
+            return str(first_content.text)
+        return str(first_content)
+    return ""
+
+async def _refresh_schema(session) -> None:
+    """Background refresh: re-fetch the schema and update both caches"""
+    try:
+        schema = await _fetch_schema(session)
+    except Exception as e:
+        print(f"Warning: background schema refresh failed: {e}")
+        return
+    _schema_cache[id(session)] = (time.monotonic(), schema)
+    await asyncio.to_thread(_save_schema_to_disk, schema)
 
 async def get_database_schema(session) -> str:
-    """Get database schema from MCP session"""
+    """Get database schema from MCP session (cached per session and on disk)"""
+    key = id(session)
+    cached = _schema_cache.get(key)
+    if cached and time.monotonic() - cached[0] < CACHE_TTL:
+        return cached[1]
+
+    # A fresh-enough disk copy gives a near-instant cold start; kick off
+    # a background refresh in case the schema changed since it was saved
+    disk_schema = _load_schema_from_disk()
+    if disk_schema is not None:
+        _schema_cache[key] = (time.monotonic(), disk_schema)
+        _spawn_background(_refresh_schema(session))
+        return disk_schema
+
     try:
-        context_response = await session.read_resource("postgres://schema")
-        if context_response.contents and len(context_response.contents) > 0:
-            first_content = context_response.contents[0]
-            if hasattr(first_content, 'text'):
-                return str(first_content.text)
-            else:
-                return str(first_content)
-        return ""
+        schema = await _fetch_schema(session)
+        _schema_cache[key] = (time.monotonic(), schema)
+        if schema:
+            await asyncio.to_thread(_save_schema_to_disk, schema)
+        return schema
     except Exception as e:
         print(f"Warning: Could not read schema resource: {e}")
         return ""
 
 async def get_available_tools(session) -> list:
-    """Get available tools from MCP session"""
+    """Get available tools from MCP session (cached per session)"""
+    key = id(session)
+    cached = _tools_cache.get(key)
+    if cached and time.monotonic() - cached[0] < CACHE_TTL:
+        return cached[1]
+
     tools_call = await session.list_tools()
-    return [{
+    available_tools = [{
         "name": tool.name,
         "description": tool.description,
         "input_schema": tool.inputSchema
     } for tool in tools_call.tools]
+    _tools_cache[key] = (time.monotonic(), available_tools)
+    return available_tools
 
-async def planning_phase(prompt: str, context: str) -> str:
+async def planning_phase(prompt: str, context: str, budget: TokenBudget = None) -> str:
     """Phase 1: Generate execution plan"""
-    planning_prompt = f"""You are a SQL query planner. Analyze the user's request and create a detailed execution plan.
-                            User Request: {prompt}
-                            Available Database Schema: {context}
-
-                            Create a comprehensive plan in this EXACT format:
-
-                            # CONTEXT:
-                            [Elaborate on what the user is asking for - be specific about the data they want]
-
-                            # OBJECTIVE:
-                            [Clear statement of what needs to be accomplished, including specific table names and data points needed]
-
-                            # INSTRUCTIONS:
-                            [Step-by-step execution plan that includes:
-                            1. Which table schemas to fetch (use postgres://<tablename>/schema)
-                            2. What specific data to query for
-                            3. How to structure the final response]
-
-                            # EXAMPLE:
-                            [Show an example of what the final answer should look like]
-
-                            Make sure to complete ALL sections fully."""
-
-    messages = [create_message(planning_prompt)]
+    # Instructions and schema form a stable prefix that the API caches
+    # across queries in a session; only the user request varies
+    messages = [create_message([
+        {"type": "text", "text": PLANNING_INSTRUCTIONS,
+         "cache_control": {"type": "ephemeral"}},
+        {"type": "text",
+         "text": PLANNING_SCHEMA_TEMPLATE.format(context=compact_schema(context)),
+         "cache_control": {"type": "ephemeral"}},
+        {"type": "text", "text": PLANNING_REQUEST_TEMPLATE.format(prompt=prompt)}
+    ])]
     
     try:
-        response = await call_anthropic(messages, max_tokens=1500)
+        max_tokens = min(1500, budget.remaining_out) if budget else 1500
+        response = await call_anthropic(messages, max_tokens=max_tokens, model=PLANNING_MODEL)
+        print(f"Planning tokens: in={response.usage.input_tokens} out={response.usage.output_tokens}")
+        if budget:
+            budget.record(response.usage)
         planning_text = extract_response_text(response)
         
         # Save planning output
-        os.makedirs('data', exist_ok=True)
-        with open('data/planning_log.txt', 'w+') as f:
-            f.write(planning_text)
-        
+        write_log('data/planning_log.txt', planning_text)
+
         return planning_text
         
     except Exception as e:
         raise Exception(f"Error in planning phase: {str(e)}")
 
-async def execution_phase(prompt: str, planning_text: str, session, available_tools: list) -> str:
+async def execution_phase(prompt: str, planning_text: str, session, available_tools: list,
+                          budget: TokenBudget = None) -> str:
     """Phase 2: Execute the plan using tools"""
     
-    execution_prompt = f"""You are a SQL execution assistant. Use the provided plan to complete the user's request.
-                            ORIGINAL USER REQUEST: {prompt}
-
-                            EXECUTION PLAN:
-                            {planning_text}
-
-                            Now execute this plan step by step:
-                            1. Use the tools available to gather the required data
-                            2. Follow the instructions from the plan
-                            3. Provide a complete answer in the format specified in the EXAMPLE section
-
-                            Begin execution now."""
-
-    messages = [create_message(execution_prompt)]
+    messages = [create_message([
+        {"type": "text", "text": EXECUTION_INSTRUCTIONS,
+         "cache_control": {"type": "ephemeral"}},
+        {"type": "text",
+         "text": EXECUTION_CONTEXT_TEMPLATE.format(prompt=prompt, planning_text=planning_text)}
+    ])]
     
     try:
+        # With no tools there is nothing to execute - answer in a single
+        # call instead of spinning the agent loop
+        if not available_tools:
+            max_tokens = min(2000, budget.remaining_out) if budget else 2000
+            response = await call_anthropic(messages, max_tokens=max_tokens)
+            if budget:
+                budget.record(response.usage)
+            final_response = extract_response_text(response)
+            write_log('data/execution_log.txt', final_response)
+            return final_response
+
         # Keep making API calls until no more tool calls are needed
         max_iterations = 10
         iteration = 0
@@ -128,45 +360,48 @@ async def execution_phase(prompt: str, planning_text: str, session, available_to
             iteration += 1
             
             # Make Claude API call
-            response = await call_anthropic(messages, available_tools, max_tokens=2000)
-            
+            max_tokens = min(2000, budget.remaining_out) if budget else 2000
+            response = await call_anthropic(messages, available_tools, max_tokens=max_tokens)
+            print(f"Execution tokens (iteration {iteration}): in={response.usage.input_tokens} out={response.usage.output_tokens}")
+            if budget:
+                budget.record(response.usage)
+
             # Add assistant's response to conversation
             messages.append({
                 "role": "assistant",
                 "content": response.content
             })
             
-            # Check if there are any tool calls to execute
-            tool_calls_made = False
-            tool_results = []
-            
-            for content in response.content:
-                if hasattr(content, 'type') and content.type == 'tool_use':
-                    tool_calls_made = True
-                    tool_name = content.name
-                    tool_args = content.input
-                    
-                    print(f"Calling tool: {tool_name} with args: {tool_args}")
-                    
-                    # Execute tool call
-                    try:
-                        result = await session.call_tool(tool_name, tool_args)
-                        tool_results.append({
-                            "type": "tool_result",
-                            "tool_use_id": content.id,
-                            "content": str(result.content) if hasattr(result, 'content') else str(result)
-                        })
-                    except Exception as e:
-                        tool_results.append({
-                            "type": "tool_result",
-                            "tool_use_id": content.id,
-                            "content": f"Error: {str(e)}",
-                            "is_error": True
-                        })
-            
-            # If no tool calls were made, we're done
-            if not tool_calls_made:
+            # The API says whether it paused for tools - exact, and no
+            # scan of the content blocks needed to decide termination
+            if response.stop_reason != "tool_use":
                 break
+
+            # Collect tool calls and run them concurrently - they are
+            # independent and I/O-bound, so the iteration takes as long
+            # as the slowest call instead of the sum
+            tool_uses = [content for content in response.content
+                         if getattr(content, 'type', None) == 'tool_use']
+
+            async def run_tool(tool_use):
+                print(f"Calling tool: {tool_use.name} with args: {tool_use.input}")
+                try:
+                    content = await call_tool_cached(session, tool_use.name, tool_use.input)
+                    return {
+                        "type": "tool_result",
+                        "tool_use_id": tool_use.id,
+                        "content": content
+                    }
+                except Exception as e:
+                    return {
+                        "type": "tool_result",
+                        "tool_use_id": tool_use.id,
+                        "content": f"Error: {str(e)}",
+                        "is_error": True
+                    }
+
+            # gather preserves order, so results stay aligned with tool_use ids
+            tool_results = list(await asyncio.gather(*(run_tool(use) for use in tool_uses)))
             
             # Add tool results to the conversation
             if tool_results:
@@ -174,29 +409,54 @@ async def execution_phase(prompt: str, planning_text: str, session, available_to
                     "role": "user",
                     "content": tool_results
                 })
+
+            # Stop before the next call if the budget can't cover it
+            if budget and budget.exhausted():
+                print("Token budget exhausted, stopping execution loop")
+                break
         
         # Extract final response
         final_response = extract_response_text(response)
         
         # Save execution log
-        with open('data/execution_log.txt', 'w+') as f:
-            f.write(final_response)
-        
+        write_log('data/execution_log.txt', final_response)
+
         return final_response
         
     except Exception as e:
         raise Exception(f"Error in execution phase: {str(e)}")
 
-async def process_prompt(session, prompt: str) -> str:
-    """Main function: Two-step process with planning and execution"""
+async def process_prompt(session, prompt: str, available_tools: list = None) -> str:
+    """Main function: Two-step process with planning and execution
+
+    Callers that already hold the session's tool list (e.g. MCPClient,
+    which discovers tools at connect time) can pass it in to skip the
+    per-query list_tools round trip.
+    """
     try:
-        # Get prerequisites
+        # Planning only needs the schema, so run it concurrently with
+        # tool discovery instead of awaiting each step in sequence
         context = await get_database_schema(session)
-        available_tools = await get_available_tools(session)
-        
-        planning_text = await planning_phase(prompt, context)
-        
-        final_result = await execution_phase(prompt, planning_text, session, available_tools)
+        budget = TokenBudget()
+        planning_task = asyncio.create_task(planning_phase(prompt, context, budget))
+        tools_task = None
+        if available_tools is None:
+            tools_task = asyncio.create_task(get_available_tools(session))
+
+        try:
+            planning_text = await planning_task
+        except Exception:
+            if tools_task:
+                tools_task.cancel()
+            raise
+
+        if tools_task:
+            try:
+                available_tools = await tools_task
+            except Exception as e:
+                raise Exception(f"Error fetching tools: {str(e)}")
+
+        final_result = await execution_phase(prompt, planning_text, session, available_tools, budget)
         
         return final_result
         